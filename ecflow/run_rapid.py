@@ -47,6 +47,8 @@ plain_table_task.add_trigger("ensemble_family == complete")
 plain_table_task.add_variable("PYSCRIPT", os.path.join(home, 'spt_extract_plain_table.py'))
 plain_table_task.add_variable("OUT_LOCATION", "/home/michael/host_share/japan-io/output")
 plain_table_task.add_variable("LOG_FILE", os.path.join(home, 'run_rapid/ecf_out/plain_table.log'))
+# NCES_EXEC is unused since the ensemble stats are computed in Python; it is still passed so that
+# the era type stays the fourth argument of spt_extract_plain_table.py
 plain_table_task.add_variable("NCES_EXEC", "/home/michael/miniconda3/envs/ecflow/bin/nces")
 
 print(defs)
@@ -7,7 +7,7 @@
 # Purpose: Calculate basic statistics for GloFAS-RAPID files and
 #          extract them to a summary table; interpolate forecast
 #          values for time steps other than 3 hrs
-# Requirements: NCO, netCDF4, pandas
+# Requirements: netCDF4, numpy, pandas
 #
 #################################################################
 
@@ -15,110 +15,160 @@ import os
 from glob import glob
 import sys
 import multiprocessing as mp
-import subprocess as sp
 import netCDF4 as nc
-import datetime as dt
+import numpy as np
 import pandas as pd
 import logging
 
 
-def extract_summary_table(workspace):
-    # calls NCO's nces function to calculate ensemble statistics for the max, mean, and min
-    nces_exec = str(sys.argv[3])
-    for stat in ['max', 'avg', 'min']:
-        findstr = 'find {0} -name "Qout*.nc"'.format(workspace)
-        filename = os.path.join(workspace, 'nces.{0}.nc'.format(stat))
-        ncesstr = "{0} -O --op_typ={1} {2}".format(nces_exec, stat, filename)
-        args = ' | '.join([findstr, ncesstr])
-        sp.call(args, shell=True)
-
-    # creates list with the stat netcdf files created in the previous step
-    nclist = []
-    for file in os.listdir(workspace):
-        if file.startswith("nces"):
-            nclist.append(os.path.join(workspace, file))
+# flow classification breakpoints and the labels assigned to each bin
+color_labels = np.array(['blue', 'yellow', 'red', 'purple'])
+thick_edges = np.array([20, 250, 1500, 10000, 30000], dtype=np.float32)
+thick_labels = np.array(['1', '2', '3', '4', '5', '6'])
 
-    # creates file name for the csv file
-    date_string = os.path.split(workspace)[1].replace('.', '')
-    full_name = os.path.split(os.path.split(workspace)[0])[1]
-    file_name = 'summary_table_{0}_{1}.csv'.format(full_name, date_string)
+# return periods of each watershed, set in pool workers by init_worker; None marks a watershed
+# whose return periods failed to load in the parent process
+return_periods = {}
 
-    # creating pandas dataframe with return periods
-    era_type = str(sys.argv[4])
-    rp_path = glob(os.path.join(os.path.split(workspace)[0], f'return_periods_{era_type}*.nc'))[0]
+
+# classifies mean flows of shape (reach, timestep) into indices of the color and thickness labels;
+# missing (NaN) flows get index -1 instead of a label and are flagged in the returned mask
+def classify_reaches(means, rp_table):
+    # define reach color based on return periods (count of thresholds exceeded)
+    color_idx = np.zeros(means.shape, dtype=np.int8)
+    for threshold in rp_table.T:
+        color_idx += means > threshold[:, np.newaxis]
+
+    # define reach thickness based on flow magnitude
+    thick_idx = np.searchsorted(thick_edges, means, side='right')
+
+    missing = np.isnan(means)
+    if missing.any():
+        color_idx[missing] = -1
+        thick_idx[missing] = -1
+
+    return color_idx, thick_idx, missing
+
+
+# calculates the ensemble max and mean of the member Qout files in a single pass, along with
+# the COMIDs and raw times read from the first member; missing values are skipped like nces does
+def ensemble_stats(qout_files):
+    if not qout_files:
+        raise FileNotFoundError('No Qout files to calculate ensemble statistics from')
+
+    maxes = None
+    for qout_file in qout_files:
+        res = nc.Dataset(qout_file, 'r')
+        try:
+            if maxes is None:
+                comids = np.asarray(res.variables['rivid'][:])
+                rawdates = np.asarray(res.variables['time'][0:49])
+            qout = np.ma.filled(res.variables['Qout'][:, 0:49], np.nan).astype(np.float32, copy=False)
+        finally:
+            res.close()
+
+        if maxes is None:
+            maxes = np.full(qout.shape, np.nan, dtype=np.float32)
+            sums = np.zeros(qout.shape, dtype=np.float64)
+            counts = np.zeros(qout.shape, dtype=np.int32)
+
+        valid = ~np.isnan(qout)
+        np.fmax(maxes, qout, out=maxes)
+        sums += np.where(valid, qout, 0)
+        counts += valid
+
+    # cells missing in every member are left as NaN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (sums / counts).astype(np.float32)
+
+    return comids, rawdates, maxes, means
+
+
+# reads the return periods of a watershed into its COMIDs and a (reach, threshold) array
+def load_return_periods(watershed, era_type):
+    rp_path = glob(os.path.join(watershed, f'return_periods_{era_type}*.nc'))[0]
     rp_ncfile = nc.Dataset(rp_path, 'r')
 
     # extract values
-    rp_comid = rp_ncfile.variables['rivid'][:]
-    data = {
-        'return_2': rp_ncfile.variables['return_period_2'][:],
-        'return_10': rp_ncfile.variables['return_period_10'][:],
-        'return_20': rp_ncfile.variables['return_period_20'][:]
-    }
+    rp_comid = np.asarray(rp_ncfile.variables['rivid'][:])
+    rp_table = np.column_stack([
+        np.ma.filled(rp_ncfile.variables['return_period_2'][:], np.nan),
+        np.ma.filled(rp_ncfile.variables['return_period_10'][:], np.nan),
+        np.ma.filled(rp_ncfile.variables['return_period_20'][:], np.nan)
+    ]).astype(np.float32, copy=False)
+    rp_ncfile.close()
+
+    return rp_path, rp_comid, rp_table
+
 
-    #  creates dataframe
-    rp_df = pd.DataFrame(data, index=rp_comid)
+# stores the return periods loaded by the parent process in a pool worker
+def init_worker(shared_return_periods):
+    return_periods.update(shared_return_periods)
+
+
+def extract_summary_table(workspace):
+    # finds the ensemble member files of the forecast
+    qout_files = sorted(glob(os.path.join(workspace, '**', 'Qout*.nc'), recursive=True))
+
+    # creates file name for the csv file
+    date_string = os.path.split(workspace)[1].replace('.', '')
+    full_name = os.path.split(os.path.split(workspace)[0])[1]
+    file_name = 'summary_table_{0}_{1}.csv'.format(full_name, date_string)
 
     # creates a csv file to store statistics
     try:
-        with open(os.path.join(workspace, file_name), 'w') as f:
-            # writes header
-            # f.write('comid,timestamp,max,mean,color,thickness\n')
-
-            # extracts forecast COMIDS and formatted dates into lists
-            comids = nc.Dataset(nclist[0], 'r').variables['rivid'][:].tolist()
-            rawdates = nc.Dataset(nclist[0], 'r').variables['time'][:].tolist()
-            dates = []
-            for date in rawdates:
-                dates.append(dt.datetime.utcfromtimestamp(date).strftime("%m/%d/%y %H:%M"))
-
-            # creates empty lists with forecast stats
-            maxlist = []
-            meanlist = []
-
-            # loops through the stat netcdf files to populate lists created above
-            for ncfile in sorted(nclist):
-                res = nc.Dataset(ncfile, 'r')
-
-                # loops through COMIDs with netcdf files
-                for index, comid in enumerate(comids):
-                    if 'max' in ncfile:
-                        maxlist.append(res.variables['Qout'][index, 0:49].tolist())
-                    elif 'avg' in ncfile:
-                        meanlist.append(res.variables['Qout'][index, 0:49].tolist())
-
-            # loops through COMIDs again to add rows to csv file
-            for index, comid in enumerate(comids):
-                for f_date, f_max, f_mean in zip(dates, maxlist[index], meanlist[index]):
-                    # define reach color based on return periods
-                    if f_mean > rp_df.loc[comid, 'return_20']:
-                        color = 'purple'
-                    elif f_mean > rp_df.loc[comid, 'return_10']:
-                        color = 'red'
-                    elif f_mean > rp_df.loc[comid, 'return_2']:
-                        color = 'yellow'
-                    else:
-                        color = 'blue'
-
-                    # define reach thickness based on flow magnitude
-                    if f_mean < 20:
-                        thickness = '1'
-                    elif 20 <= f_mean < 250:
-                        thickness = '2'
-                    elif 250 <= f_mean < 1500:
-                        thickness = '3'
-                    elif 1500 <= f_mean < 10000:
-                        thickness = '4'
-                    elif 10000 <= f_mean < 30000:
-                        thickness = '5'
-                    else:
-                        thickness = '6'
-
-                    f.write(','.join([str(comid), f_date, str(f_max), str(f_mean), color, thickness + '\n']))
+        # uses the return periods loaded by the parent process, reading them only when called outside the pool
+        watershed = os.path.split(workspace)[0]
+        if not return_periods:
+            rp_path, rp_comid, rp_table = load_return_periods(watershed, str(sys.argv[4]))
+        elif return_periods.get(watershed) is None:
+            raise RuntimeError('Return periods for {0} could not be loaded'.format(watershed))
+        else:
+            rp_path, rp_comid, rp_table = return_periods[watershed]
+
+        # calculates the ensemble max and mean as (reach, timestep) arrays
+        comids, rawdates, maxes, means = ensemble_stats(qout_files)
+
+        # converts forecast times, which are only formatted when the csv is written
+        dates = rawdates.astype(np.int64).astype('datetime64[s]')
+
+        n_steps = means.shape[1]
+
+        # classifies every reach against its own return periods
+        row_idx = pd.Index(rp_comid).get_indexer(comids)
+        if (row_idx < 0).any():
+            raise KeyError('COMIDs missing from {0}'.format(rp_path))
+        color_idx, thick_idx, missing = classify_reaches(means, rp_table[row_idx])
+
+        summary_table_df = pd.DataFrame({
+            'comid': np.repeat(comids, n_steps),
+            'timestamp': np.tile(dates, len(comids)),
+            'max': maxes.ravel(),
+            'mean': means.ravel(),
+            'color': pd.Categorical.from_codes(color_idx.ravel(), color_labels),
+            'thickness': pd.Categorical.from_codes(thick_idx.ravel(), thick_labels)
+        }, copy=False)
+
+        # drops timesteps missing in every ensemble member rather than writing them without a label
+        if missing.any():
+            summary_table_df = summary_table_df[~missing.ravel()]
+        summary_table_df.to_csv(os.path.join(workspace, file_name), header=False, index=False,
+                                date_format="%m/%d/%y %H:%M")
 
         return 'Stat Success'
+    except Exception:
+        logging.exception('Failed to extract summary table for {0}'.format(workspace))
+        raise
+
+
+# runs extract_summary_table in a pool worker, returning the error instead of raising it so that
+# one failed workspace doesn't stop the others
+def summarize_workspace(workspace):
+    try:
+        extract_summary_table(workspace)
+        return workspace, None
     except Exception as e:
-        logging.debug(e)
+        return workspace, '{0}: {1}'.format(type(e).__name__, e)
 
 
 # runs function on file execution
@@ -139,9 +189,28 @@ if __name__ == "__main__":
 
     logging.basicConfig(filename=str(sys.argv[2]), level=logging.DEBUG)
 
-    pool = mp.Pool()
-    results = pool.map(extract_summary_table, dates)
-
-    pool.close()
-    pool.join()
+    # reads the return periods of each watershed once and shares them with every worker; watersheds
+    # whose return periods can't be loaded are marked with None so their workspaces fail without reloading
+    # argv[3] used to be the NCO nces executable and is no longer used; it is kept only so the era type
+    # stays at argv[4], where the plain table task passes it
+    era_type = str(sys.argv[4])
+    shared_return_periods = {}
+    for watershed in sorted({os.path.split(d)[0] for d in dates}):
+        try:
+            shared_return_periods[watershed] = load_return_periods(watershed, era_type)
+        except Exception:
+            logging.exception('Failed to load return periods for {0}'.format(watershed))
+            shared_return_periods[watershed] = None
+
+    # recycles workers every few workspaces to release memory held by the netCDF/HDF5 libraries
+    failures = []
+    with mp.Pool(initializer=init_worker, initargs=(shared_return_periods,), maxtasksperchild=4) as pool:
+        for workspace, error in pool.imap_unordered(summarize_workspace, dates, chunksize=2):
+            if error is not None:
+                logging.error('Summary table failed for {0}: {1}'.format(workspace, error))
+                failures.append(workspace)
     logging.debug('Finished')
+
+    if failures:
+        logging.error('{0} of {1} workspaces failed'.format(len(failures), len(dates)))
+        sys.exit(1)